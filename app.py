@@ -1,22 +1,70 @@
-from flask import Flask, send_file
-from datetime import datetime
+from flask import Flask, Response
+from flask.logging import default_handler
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone as dt_timezone
+import atexit
 import base64
 import json
+import logging
 import os
-import io
-import pytz
+import pickle
+import queue
+import sqlite3
+import tempfile
+import time
+import threading
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 import gspread
+from cachetools import TTLCache
+from gspread.urls import SPREADSHEETS_API_V4_BASE_URL
+from gspread.utils import a1_to_rowcol, absolute_range_name, rowcol_to_a1
+from google.auth.transport.requests import AuthorizedSession
 from google.oauth2.service_account import Credentials
-
-app = Flask(__name__)
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # === CONFIG ===
 SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
     "https://www.googleapis.com/auth/drive",
 ]
-IST                   = pytz.timezone("Asia/Kolkata")
-MAILTRACKING_WORKBOOK = "MailTracking"
+IST = dt_timezone(timedelta(hours=5, minutes=30), "IST")  # fixed, no DST
+
+
+@dataclass(frozen=True)
+class SchemaConfig:
+    """Sheet layout the tracker writes to: the workbook and each column's header."""
+    workbook:       str
+    timestamp_col:  str = "Open_timestamp"
+    status_col:     str = "Open_status"
+    email_col:      str = "Leads_email"
+    count_col:      str = "Open_count"
+    last_open_col:  str = "Last_open_timestamp"
+    sender_col:     str = "From"
+    subject_col:    str = "Subject"
+    campaign_col:   str = "Campaign_name"
+    timezone_col:   str = "Timezone"
+    start_date_col: str = "Start_Date"
+    template_col:   str = "Template"
+
+    @property
+    def columns(self) -> tuple:
+        """Every header, in the order written to an empty tab."""
+        return (
+            self.timestamp_col, self.status_col, self.email_col, self.count_col,
+            self.last_open_col, self.sender_col, self.subject_col,
+            self.campaign_col, self.timezone_col, self.start_date_col,
+            self.template_col,
+        )
+
+
+SCHEMAS = {
+    "V1": SchemaConfig(
+        workbook=os.environ.get("MAILTRACKING_WORKBOOK", "MailTracking"),
+    ),
+}
+SCHEMA = SCHEMAS[os.environ.get("SCHEMA", "V1")]
 
 # Transparent 1×1 GIF payload
 PIXEL_BYTES = (
@@ -26,128 +74,810 @@ PIXEL_BYTES = (
     b"L\x01\x00;"
 )
 
+# Built once and returned as-is for every hit. Behind nginx, set
+# PIXEL_ACCEL_REDIRECT (e.g. "/_pixel.gif") to hand the body off to it:
+#
+#   location /_pixel.gif {
+#       internal;
+#       alias /srv/tracker/pixel.gif;
+#       add_header Cache-Control "no-store";
+#   }
+PIXEL_ACCEL_REDIRECT = os.environ.get("PIXEL_ACCEL_REDIRECT")
+if PIXEL_ACCEL_REDIRECT:
+    PIXEL_RESPONSE = Response(
+        b"",
+        mimetype="image/gif",
+        headers={
+            "Cache-Control":    "no-store",
+            "X-Accel-Redirect": PIXEL_ACCEL_REDIRECT,
+        },
+    )
+else:
+    PIXEL_RESPONSE = Response(
+        PIXEL_BYTES,
+        mimetype="image/gif",
+        headers={
+            "Cache-Control":  "no-store",
+            "Content-Length": str(len(PIXEL_BYTES)),
+        },
+    )
+
 # === Google Sheets client ===
+# Parsed once at import; under `gunicorn --preload` forked workers share it
 creds_info = json.loads(os.environ["GOOGLE_CREDS_JSON"])
 creds      = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-gc         = gspread.authorize(creds)
 
+# Authorised lazily so each worker process builds its own client/session
+# instead of inheriting one created at import time
+_gc      = None
+_gc_lock = threading.Lock()
+
+
+def get_client():
+    global _gc
+    with _gc_lock:
+        if _gc is None:
+            # pooled keep-alive session so API calls reuse TLS connections
+            session = AuthorizedSession(creds)
+            session.mount("https://", HTTPAdapter(
+                pool_connections=20,
+                pool_maxsize=50,
+                max_retries=Retry(
+                    total=3,
+                    backoff_factor=0.2,
+                    status_forcelist=(429, 500, 502, 503),
+                ),
+            ))
+            _gc = gspread.Client(auth=creds, session=session)
+        return _gc
+
+# === Workbook / worksheet handles ===
+# Re-validated every WS_TTL seconds, or sooner when Sheets answers 404
+WS_TTL      = 600  # seconds
+_wb         = None
+_ws_cache   = {}  # tab title → gspread.Worksheet, in workbook order
+_cache_time = 0
+_ws_lock    = threading.Lock()
+
+
+def _load_worksheets():
+    global _wb, _cache_time
+    _wb = get_client().open(SCHEMA.workbook)
+    _ws_cache.clear()
+    for ws in _wb.worksheets():
+        _ws_cache[ws.title] = ws
+    _cache_time = time.time()
+
+
+def get_ws(tab: str = None):
+    """
+    Return the cached worksheet for `tab` (first tab when not given),
+    creating the tab if the workbook does not have it yet.
+    """
+    with _ws_lock:
+        if _wb is None or time.time() - _cache_time >= WS_TTL:
+            _load_worksheets()
+        if not tab:
+            tab = next(iter(_ws_cache), "USA")
+        if tab not in _ws_cache:
+            _load_worksheets()  # may have been added elsewhere
+        if tab not in _ws_cache:
+            _ws_cache[tab] = _wb.add_worksheet(title=tab, rows="1000", cols="20")
+        return _ws_cache[tab]
+
+
+def invalidate_ws():
+    global _wb
+    with _ws_lock:
+        _wb = None
+        _ws_cache.clear()
+
+# === Open buffer ===
+# track() only appends to a local SQLite queue; a background flusher drains
+# it every FLUSH_INTERVAL seconds and writes the coalesced opens to Sheets.
+# Opens are claimed before the write and deleted only once it succeeded; a
+# claim left behind by a dead flusher expires after CLAIM_TIMEOUT.
+OPENS_DB       = os.environ.get("OPENS_DB", "opens.db")
+FLUSH_INTERVAL = 30   # seconds
+CLAIM_TIMEOUT  = 600  # seconds
+MAX_ATTEMPTS   = 5    # failed flushes before an open is dead-lettered
+CLAIM_LIMIT    = 5000 # opens per flush; the rest wait for the next one
+OPEN_FIELDS    = (
+    "email", "sender", "timestamp", "sheet_tab", "sheet_name",
+    "subject", "timezone", "start_date", "template",
+)
+
+db       = None  # opened per process by start_worker()
+_db_lock = threading.Lock()  # one connection shared by request threads
+
+
+def _open_db():
+    global db, _db_lock
+    _db_lock = threading.Lock()
+    db = sqlite3.connect(OPENS_DB, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(f"CREATE TABLE IF NOT EXISTS opens ({', '.join(OPEN_FIELDS)})")
+    columns = {row[1] for row in db.execute("PRAGMA table_info(opens)")}
+    for column, decl in (
+        ("claimed_by", "TEXT"),
+        ("claimed_at", "REAL"),
+        ("attempts",   "INTEGER NOT NULL DEFAULT 0"),
+    ):
+        if column not in columns:
+            db.execute(f"ALTER TABLE opens ADD COLUMN {column} {decl}")
+    db.execute(
+        f"CREATE TABLE IF NOT EXISTS dead_opens "
+        f"({', '.join(OPEN_FIELDS)}, attempts, failed_at, reason)"
+    )
+
+
+@contextmanager
+def _transaction():
+    """Serialise on the shared connection and hold SQLite's write lock."""
+    with _db_lock:
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+
+def buffer_open(*values):
+    """Queue one raw open, in OPEN_FIELDS order."""
+    with _db_lock:
+        db.execute(
+            f"INSERT INTO opens ({', '.join(OPEN_FIELDS)}) "
+            f"VALUES ({', '.join('?' * len(OPEN_FIELDS))})",
+            values,
+        )
+
+
+def _claim_opens():
+    """
+    Mark up to CLAIM_LIMIT unclaimed (or expired) opens as ours and return
+    them as (rowid, *OPEN_FIELDS) tuples. BEGIN IMMEDIATE keeps flushers in
+    other worker processes from claiming the same rows.
+    """
+    token = f"{os.getpid()}:{time.time()}"
+    now   = time.time()
+    with _transaction():
+        db.execute(
+            "UPDATE opens SET claimed_by = ?, claimed_at = ? WHERE rowid IN ("
+            "SELECT rowid FROM opens WHERE claimed_by IS NULL OR claimed_at < ? "
+            "ORDER BY rowid LIMIT ?)",
+            (token, now, now - CLAIM_TIMEOUT, CLAIM_LIMIT),
+        )
+        return db.execute(
+            f"SELECT rowid, {', '.join(OPEN_FIELDS)} FROM opens "
+            f"WHERE claimed_by = ? ORDER BY rowid",
+            (token,),
+        ).fetchall()
+
+
+def _settle(rowids):
+    """Delete opens that are now in the sheet."""
+    with _transaction():
+        db.executemany("DELETE FROM opens WHERE rowid = ?", [(r,) for r in rowids])
+
+
+def _dead_letter(rowids, reason):
+    """Move opens that can never be written out of the queue."""
+    with _transaction():
+        db.executemany(
+            f"INSERT INTO dead_opens SELECT {', '.join(OPEN_FIELDS)}, attempts, ?, ? "
+            f"FROM opens WHERE rowid = ?",
+            [(time.time(), reason, r) for r in rowids],
+        )
+        db.executemany("DELETE FROM opens WHERE rowid = ?", [(r,) for r in rowids])
+
+
+def _release(rowids, reason):
+    """Hand opens back for the next flush, dead-lettering any out of attempts."""
+    with _transaction():
+        db.executemany(
+            "UPDATE opens SET claimed_by = NULL, claimed_at = NULL, "
+            "attempts = attempts + 1 WHERE rowid = ?",
+            [(r,) for r in rowids],
+        )
+        exhausted = [
+            r for r in rowids
+            if db.execute(
+                "SELECT 1 FROM opens WHERE rowid = ? AND attempts >= ?",
+                (r, MAX_ATTEMPTS),
+            ).fetchone()
+        ]
+    if exhausted:
+        _dead_letter(exhausted, f"gave up after {MAX_ATTEMPTS} attempts: {reason}")
+
+
+def _coalesce(rows):
+    """
+    Fold repeat opens of the same email into one record carrying the open
+    count, the first/last timestamps, the latest non-empty metadata and the
+    buffer rowids behind it (`rowids`, settled once the write lands).
+    """
+    merged = {}
+    for rowid, *values in rows:
+        fields = dict(zip(OPEN_FIELDS, values))
+        key    = fields["email"]  # normalised in track()
+        if key not in merged:
+            merged[key] = dict(
+                fields, count=1, first_timestamp=fields["timestamp"], rowids=[rowid]
+            )
+            continue
+        prev = merged[key]
+        prev["count"] += 1
+        prev["rowids"].append(rowid)
+        for field, value in fields.items():
+            if value and field != "email":
+                prev[field] = value
+    return list(merged.values())
+
+
+def _is_permanent(e) -> bool:
+    """
+    Errors a retry cannot fix: bad data, or a 4xx other than 404/408/429.
+    A request rejected for its size (413/414, or a 400 saying the payload
+    exceeds the limit) is our batching, not the opens, so it is retried.
+    """
+    if isinstance(e, ValueError):
+        return True
+    if isinstance(e, gspread.exceptions.APIError):
+        status = e.response.status_code
+        if status in (413, 414) or (status == 400 and "exceeds the limit" in str(e)):
+            return False
+        return 400 <= status < 500 and status not in (404, 408, 429)
+    return False
+
+
+def _flush_failed(e, sheet, tab, rowids):
+    if (
+        isinstance(e, gspread.exceptions.APIError)
+        and e.response.status_code == 404
+    ):
+        invalidate_ws()  # tab or workbook vanished under us
+    if sheet is not None:
+        # a partial write may have left the index out of step
+        row_index.pop((SCHEMA.workbook, sheet.title), None)
+        COLS.pop((SCHEMA.workbook, sheet.title), None)  # headers may have changed
+    if _is_permanent(e):
+        app.logger.error("Dropping %d opens for %s: %s", len(rowids), tab, e)
+        _dead_letter(rowids, str(e))
+    else:
+        app.logger.error("Cannot flush %d opens to %s: %s", len(rowids), tab, e)
+        _release(rowids, str(e))
+
+
+def flush_opens():
+    """
+    Drain the buffer into Sheets: one append_rows per tab for new leads,
+    then a single values:batchUpdate covering existing leads on every tab.
+    """
+    rows      = _claim_opens()
+    unsettled = {row[0] for row in rows}
+    try:
+        by_tab = {}
+        for row in rows:
+            by_tab.setdefault(row[1 + OPEN_FIELDS.index("sheet_tab")], []).append(row)
+
+        # several tab values can name one worksheet (no tab → the first one);
+        # group by worksheet so each lead's count is read and written once
+        by_sheet = {}
+        for tab, tab_rows in by_tab.items():
+            try:
+                sheet = get_ws(tab)
+            except Exception as e:
+                rowids = [row[0] for row in tab_rows]
+                _flush_failed(e, None, tab, rowids)
+                unsettled.difference_update(rowids)
+                continue
+            by_sheet.setdefault(sheet.title, (sheet, []))[1].extend(tab_rows)
+
+        data    = []  # value ranges for existing leads, across all tabs
+        pending = []  # (sheet, rowids, leads) behind those ranges
+        for title, (sheet, tab_rows) in by_sheet.items():
+            tab_rows.sort()  # rowid order, so the latest metadata wins
+            opens  = _coalesce(tab_rows)
+            rowids = [row[0] for row in tab_rows]
+            try:
+                tab_data, updated, rejected, deferred = update_sheet(sheet, opens)
+            except Exception as e:
+                _flush_failed(e, sheet, title, rowids)
+                unsettled.difference_update(rowids)
+                continue
+
+            waiting  = [r for rec in updated for r in rec["rowids"]]
+            dropped  = [r for rec in rejected for r in rec["rowids"]]
+            retry    = [r for rec in deferred for r in rec["rowids"]]
+            appended = set(rowids).difference(waiting, dropped, retry)
+            if dropped:
+                _dead_letter(dropped, f"non-numeric {SCHEMA.count_col}")
+                unsettled.difference_update(dropped)
+            if retry:
+                _release(retry, "row moved during the flush")
+                unsettled.difference_update(retry)
+            if appended:
+                _settle(appended)
+                unsettled.difference_update(appended)
+                app.logger.info(
+                    "Tracked %d opens (%d leads) → %s", len(appended),
+                    len(opens) - len(updated) - len(rejected) - len(deferred),
+                    sheet.title,
+                )
+            if tab_data:
+                data.extend(tab_data)
+                pending.append((sheet, waiting, len(updated)))
+
+        if data:
+            try:
+                pending[0][0].spreadsheet.values_batch_update(
+                    body={"valueInputOption": "RAW", "data": data}
+                )
+            except Exception as e:
+                for sheet, rowids, _ in pending:
+                    _flush_failed(e, sheet, sheet.title, rowids)
+                    unsettled.difference_update(rowids)
+            else:
+                written = [r for _, rowids, _ in pending for r in rowids]
+                _settle(written)
+                unsettled.difference_update(written)
+                for sheet, rowids, leads in pending:
+                    app.logger.info(
+                        "Tracked %d opens (%d leads) → %s", len(rowids), leads, sheet.title
+                    )
+    finally:
+        if unsettled:
+            # something above blew up; give the rest back rather than lose it
+            # (if this fails too, the claim simply expires)
+            _release(unsettled, "flush aborted")
+
+    if rows:
+        try:
+            save_row_index()
+        except OSError as e:
+            app.logger.error("Cannot persist row index: %s", e)
+
+
+def _flush_loop():
+    try:
+        init_schema()
+    except Exception as e:
+        app.logger.error("Cannot resolve sheet layout: %s", e)  # resolved lazily instead
+
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush_opens()
+        except Exception as e:
+            app.logger.error("Flush failed: %s", e)
+
+
+def _start_flusher():
+    threading.Thread(target=_flush_loop, name="opens-flusher", daemon=True).start()
+
+
+_worker_pid  = None
+_worker_lock = threading.Lock()
+
+
+def start_worker():
+    """
+    Per-process start-up, run by the first request a process serves: start
+    the log listener (first, so a failure below is visible), open the buffer
+    and start the flusher; later requests retry until it succeeds. Importing
+    the module (the gunicorn master under --preload, scripts) starts
+    nothing, so every SQLite handle and thread belongs to its worker.
+    """
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        _start_log_listener()
+        _open_db()
+        _start_flusher()
+        _worker_pid = os.getpid()
+
+# === Duplicate-hit guard ===
+# Image proxies and prefetchers fire the pixel several times in a row;
+# (email, sender, minute) keys seen recently are dropped before buffering
+_recent_hits      = TTLCache(maxsize=50_000, ttl=60)
+_recent_hits_lock = threading.Lock()  # TTLCache is not thread-safe
+
+
+def is_duplicate_hit(key) -> bool:
+    with _recent_hits_lock:
+        if key in _recent_hits:
+            return True
+        _recent_hits[key] = True
+        return False
+
+# === Column layout ===
+# (workbook, tab) → {header: column index}. The schema is fixed, so each
+# tab's header row is checked and completed once, not on every flush.
+COLS = {}
 
-def update_sheet(
-    sheet,
-    email: str,
-    sender: str,
-    timestamp: str,
-    sheet_name: str = None,
-    subject: str = None,
-    timezone: str = None,
-    start_date: str = None,
-    template: str = None
-):
+
+def get_col_map(sheet):
     """
-    Update existing row for `email` or append new.
-    Ensures header row includes all columns, then updates/appends.
+    Return the header→index map for `sheet`, resolving it on first use:
+    writes the schema's header row to an empty tab and appends any of
+    its columns that is missing.
     """
-    # 1) Ensure header row exists
+    key     = (SCHEMA.workbook, sheet.title)
+    col_map = COLS.get(key)
+    if col_map is not None:
+        return col_map
+
     headers = sheet.row_values(1)
     if not headers:
-        headers = [
-            "Open_timestamp", "Open_status", "Leads_email", "Open_count",
-            "Last_open_timestamp", "From", "Subject", "Campaign_name",
-            "Timezone", "Start_Date", "Template"
-        ]
+        headers = list(SCHEMA.columns)
         sheet.append_row(headers)
 
-    # 2) Build header→index map
     col_map = {h: i for i, h in enumerate(headers)}
-
-    # 3) Ensure all needed columns present
-    required = [
-        "Open_status", "Open_count", "Last_open_timestamp", "From", "Subject",
-        "Campaign_name", "Timezone", "Start_Date", "Template"
-    ]
-    for col in required:
+    for col in SCHEMA.columns:
         if col not in col_map:
             headers.append(col)
             col_map[col] = len(headers) - 1
             sheet.update_cell(1, len(headers), col)
 
-    # 4) Read existing rows
-    body = sheet.get_all_values()[1:]  # skip header
+    COLS[key] = col_map
+    return col_map
+
+
+def init_schema():
+    """Resolve the column layout of every existing tab up front."""
+    get_ws()  # loads every worksheet handle
+    for ws in list(_ws_cache.values()):
+        get_col_map(ws)
+
+
+# === Row index ===
+# (workbook, tab) → (built_at, {email_lower: row}); lets the flusher find
+# rows without a search. Positions are only hints: `resolve_rows` checks the
+# email cell before anything is written. Only touched from the flusher thread.
+ROW_INDEX_PATH = os.environ.get("ROW_INDEX_PATH", "row_index.pkl")
+ROW_INDEX_TTL  = 3600  # seconds
+
+
+def _load_row_index():
+    try:
+        with open(ROW_INDEX_PATH, "rb") as f:
+            data = pickle.load(f)
+    except Exception:
+        # missing, truncated or corrupt (a bad pickle can raise almost
+        # anything); start empty and rebuild from the sheet
+        return {}
+    # drop entries saved when the index still carried [row, open_count]
+    return {
+        key: entry for key, entry in data.items()
+        if all(isinstance(ridx, int) for ridx in entry[1].values())
+    }
+
+
+row_index = _load_row_index()
+
+
+def save_row_index():
+    # a temp file per writer: every worker process saves to the same path
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(ROW_INDEX_PATH)),
+        prefix=os.path.basename(ROW_INDEX_PATH) + ".",
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(row_index, f)
+        os.replace(tmp, ROW_INDEX_PATH)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+BATCH_GET_RANGES = 100  # ranges per values:batchGet; they all go in the URL
+
+
+def _batch_get(sheet, ranges) -> list:
+    """`sheet.batch_get` in chunks small enough for the request URL."""
+    values = []
+    for i in range(0, len(ranges), BATCH_GET_RANGES):
+        values.extend(sheet.batch_get(ranges[i:i + BATCH_GET_RANGES]))
+    return values
+
+
+def _col_range(col_idx: int) -> str:
+    """A1 range covering a whole column below the header, e.g. "C2:C"."""
+    letter = rowcol_to_a1(1, col_idx + 1)[:-1]
+    return f"{letter}2:{letter}"
+
+
+def get_row_index(sheet, col_map, key):
+    """
+    Return the email → row map for `sheet`, rebuilding it from the email
+    column when missing or older than ROW_INDEX_TTL.
+    """
+    entry = row_index.get(key)
+    if entry is not None and time.time() - entry[0] < ROW_INDEX_TTL:
+        return entry[1]
+
+    column = sheet.get(_col_range(col_map[SCHEMA.email_col]), major_dimension="COLUMNS")
+    emails = column[0] if column else []
+
+    index = {}
+    for i, email in enumerate(emails):
+        if email:
+            # first row wins for duplicate emails; rows written before emails
+            # were stored lower-cased still need normalising here
+            index.setdefault(email.strip().lower(), i + 2)
+
+    row_index[key] = (time.time(), index)
+    return index
+
+
+def resolve_rows(sheet, col_map, key, emails):
+    """
+    Find which of `emails` already have a row on `sheet`. Rows come from the
+    index, or from the metadata tags for emails it lacks; one values:batchGet
+    (chunked) then reads each candidate's email and Open_count cells, so
+    counts are current and a row moved by a sort or a delete is caught before
+    it is written.
+
+    A tagged row whose email no longer matches (contents cleared, tag left
+    behind) is simply a miss. An indexed row that no longer matches means
+    rows shifted: the index is rebuilt and those emails looked up once more.
+
+    Returns ({email_lower: (row, Open_count cell)}, [emails still moving]).
+    """
+    email_idx = col_map[SCHEMA.email_col]
+    count_idx = col_map[SCHEMA.count_col]
+    lo, hi    = min(email_idx, count_idx), max(email_idx, count_idx)
+
+    resolved = {}
+    pending  = list(emails)
+    for attempt in range(2):
+        index      = get_row_index(sheet, col_map, key)
+        candidates = [(email, index[email], True) for email in pending if email in index]
+        misses     = [email for email in pending if email not in index]
+        if misses:
+            # leads appended by another worker since the index was built
+            candidates.extend(
+                (email, ridx, False)
+                for email, rows in find_rows_by_metadata(sheet, misses).items()
+                for ridx in rows
+            )
+        if not candidates:
+            break
+
+        values = _batch_get(sheet, [
+            f"{rowcol_to_a1(ridx, lo + 1)}:{rowcol_to_a1(ridx, hi + 1)}"
+            for _, ridx, _ in candidates
+        ])
+        moved = []
+        for (email, ridx, indexed), value in zip(candidates, values):
+            if email in resolved:
+                continue
+            cells = value[0] if value else []
+            cell  = lambda idx: cells[idx - lo] if idx - lo < len(cells) else ""
+            if cell(email_idx).strip().lower() == email:
+                resolved[email] = (ridx, cell(count_idx))
+                index[email]    = ridx
+            elif indexed:
+                moved.append(email)
+        if not moved:
+            break
+        pending = moved
+        if attempt == 0:
+            row_index.pop(key, None)  # rows shifted under the index; rebuild it
+    else:
+        return resolved, pending
+    return resolved, []
+
+
+# === Row metadata ===
+# Each appended row is tagged with developerMetadata email=<email_lower>, so a
+# lead missing from the local index is located by Google in one search call
+EMAIL_METADATA_KEY = "email"
+
+
+def find_rows_by_metadata(sheet, emails) -> dict:
+    """Return {email_lower: [rows]} for rows of `sheet` tagged with those emails."""
+    body = {
+        "dataFilters": [
+            {
+                "developerMetadataLookup": {
+                    "metadataKey":   EMAIL_METADATA_KEY,
+                    "metadataValue": email,
+                    "locationType":  "ROW",
+                }
+            }
+            for email in emails
+        ]
+    }
+    url  = f"{SPREADSHEETS_API_V4_BASE_URL}/{sheet.spreadsheet.id}/developerMetadata:search"
+    resp = get_client().request("post", url, json=body).json()
+
+    rows = {}
+    for match in resp.get("matchedDeveloperMetadata", []):
+        meta = match["developerMetadata"]
+        span = meta["location"]["dimensionRange"]
+        if span["sheetId"] == sheet.id:
+            rows.setdefault(meta["metadataValue"], []).append(span["startIndex"] + 1)
+    return {email: sorted(ridxs) for email, ridxs in rows.items()}
+
+
+def tag_rows(sheet, rows: dict):
+    """Attach email developerMetadata to each {email_lower: row} in one batchUpdate."""
+    sheet.spreadsheet.batch_update({
+        "requests": [
+            {
+                "createDeveloperMetadata": {
+                    "developerMetadata": {
+                        "metadataKey":   EMAIL_METADATA_KEY,
+                        "metadataValue": email,
+                        "location": {
+                            "dimensionRange": {
+                                "sheetId":    sheet.id,
+                                "dimension":  "ROWS",
+                                "startIndex": ridx - 1,
+                                "endIndex":   ridx,
+                            }
+                        },
+                        "visibility": "DOCUMENT",
+                    }
+                }
+            }
+            for email, ridx in rows.items()
+        ]
+    })
+
+
+def update_sheet(sheet, opens: list):
+    """
+    Apply coalesced opens (see `_coalesce`) to `sheet`.
+    Appends unseen emails in one append_rows. Returns the value ranges for
+    existing rows, the records behind them, the records rejected for a
+    non-numeric Open_count and those whose row kept moving (retried on the
+    next flush); the caller writes ranges for all tabs in one batchUpdate.
+    """
+    # 1-3) Header layout, resolved once per tab (see `get_col_map`)
+    key     = (SCHEMA.workbook, sheet.title)
+    col_map = get_col_map(sheet)
+    width   = max(col_map.values()) + 1
+
+    # 4) Resolve and verify rows, reading their current counts
+    existing, moving = resolve_rows(sheet, col_map, key, [rec["email"] for rec in opens])
+
+    updates  = []
+    updated  = []
+    rejected = []
+    deferred = []
+    new_rows = []
+    for rec in opens:
+        if rec["email"] in moving:
+            deferred.append(rec)
+            continue
+        entry = existing.get(rec["email"])
+
+        # 5) Update existing email row
+        if entry is not None:
+            ridx, current = entry
 
-    # 5) Try update existing email row
-    for ridx, row in enumerate(body, start=2):
-        if row[col_map["Leads_email"]].strip().lower() == email.lower():
             # increment open count
-            count = int(row[col_map["Open_count"]] or "0") + 1
-            sheet.update_cell(ridx, col_map["Open_count"] + 1, str(count))
-
-            # update renamed fields
-            sheet.update_cell(ridx, col_map["Open_timestamp"] + 1, timestamp)
-            sheet.update_cell(ridx, col_map["Open_status"]    + 1, "OPENED")
-            sheet.update_cell(ridx, col_map["From"]           + 1, sender)
-
-            # update subject
-            if subject:
-                sheet.update_cell(ridx, col_map["Subject"] + 1, subject)
-
-            # update renamed metadata
-            if sheet_name:
-                sheet.update_cell(ridx, col_map["Campaign_name"] + 1, sheet_name)
-            if timezone:
-                sheet.update_cell(ridx, col_map["Timezone"]      + 1, timezone)
-            if start_date:
-                sheet.update_cell(ridx, col_map["Start_Date"]     + 1, start_date)
-            if template:
-                sheet.update_cell(ridx, col_map["Template"]       + 1, template)
-            return
+            try:
+                count = int(current or "0") + rec["count"]
+            except ValueError:
+                app.logger.error(
+                    "Non-numeric %s %r for %s on %s",
+                    SCHEMA.count_col, current, rec["email"], sheet.title,
+                )
+                rejected.append(rec)
+                continue
+
+            fields = {
+                SCHEMA.timestamp_col:  rec["timestamp"],
+                SCHEMA.status_col:     "OPENED",
+                SCHEMA.count_col:      str(count),
+                SCHEMA.sender_col:     rec["sender"],
+                SCHEMA.subject_col:    rec["subject"],
+                SCHEMA.campaign_col:   rec["sheet_name"],
+                SCHEMA.timezone_col:   rec["timezone"],
+                SCHEMA.start_date_col: rec["start_date"],
+                SCHEMA.template_col:   rec["template"],
+            }
+            updates.extend(
+                {
+                    "range":  absolute_range_name(
+                        sheet.title, rowcol_to_a1(ridx, col_map[col] + 1)
+                    ),
+                    "values": [[value]],
+                }
+                for col, value in fields.items()
+                if value
+            )
+            updated.append(rec)
+            continue
+
+        # 6) Append new row
+        new_row = [""] * width
+        new_row[col_map[SCHEMA.timestamp_col]]  = rec["timestamp"]
+        new_row[col_map[SCHEMA.status_col]]     = "OPENED"
+        new_row[col_map[SCHEMA.email_col]]      = rec["email"]
+        new_row[col_map[SCHEMA.count_col]]      = str(rec["count"])
+        new_row[col_map[SCHEMA.last_open_col]]  = rec["first_timestamp"]
+        new_row[col_map[SCHEMA.sender_col]]     = rec["sender"]
+        new_row[col_map[SCHEMA.subject_col]]    = rec["subject"] or ""
+        new_row[col_map[SCHEMA.campaign_col]]   = rec["sheet_name"] or ""
+        new_row[col_map[SCHEMA.timezone_col]]   = rec["timezone"] or ""
+        new_row[col_map[SCHEMA.start_date_col]] = rec["start_date"] or ""
+        new_row[col_map[SCHEMA.template_col]]   = rec["template"] or ""
+        new_rows.append(new_row)
+
+    # single values:append call; RAW since we never write formulas
+    if new_rows:
+        resp = sheet.append_rows(
+            new_rows, value_input_option="RAW", table_range="A1"
+        )
+
+        # index the appended rows, e.g. updatedRange "USA!A12:K14"
+        first = resp["updates"]["updatedRange"].rsplit("!", 1)[-1].split(":")[0]
+        ridx  = a1_to_rowcol(first)[0]
+        tagged = {
+            row[col_map[SCHEMA.email_col]]: ridx + offset
+            for offset, row in enumerate(new_rows)
+        }
+        get_row_index(sheet, col_map, key).update(tagged)
+        try:
+            tag_rows(sheet, tagged)
+        except Exception as e:
+            # rows are written; they just stay untagged (the index covers them)
+            app.logger.error("Cannot tag %d rows on %s: %s", len(tagged), sheet.title, e)
+
+    return updates, updated, rejected, deferred
+
 
-    # 6) Append new row
-    new_row = [""] * len(headers)
-    new_row[col_map["Open_timestamp"]]        = timestamp
-    new_row[col_map["Open_status"]]           = "OPENED"
-    new_row[col_map["Leads_email"]]           = email
-    new_row[col_map["Open_count"]]            = "1"
-    new_row[col_map["Last_open_timestamp"]]   = timestamp
-    new_row[col_map["From"]]                  = sender
-    new_row[col_map["Subject"]]               = subject or ""
-    new_row[col_map["Campaign_name"]]         = sheet_name or ""
-    new_row[col_map["Timezone"]]              = timezone or ""
-    new_row[col_map["Start_Date"]]            = start_date or ""
-    new_row[col_map["Template"]]              = template or ""
-
-    sheet.append_row(new_row)
-
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
 def track(path):
     """
     Tracking pixel endpoint.
     Expects base64-encoded JSON metadata in the URL path.
     """
+    try:
+        start_worker()
+    except Exception as e:
+        # the pixel must load regardless; this open is lost
+        app.logger.error("Cannot start worker: %s", e)
+        return PIXEL_RESPONSE
+
     now       = datetime.now(IST)
-    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+    timestamp = f"{now:%Y-%m-%d %H:%M:%S}"
 
     # Decode metadata token
     try:
         token   = path.split('.')[0]
-        padded  = token + "=" * (-len(token) % 4)
-        payload = base64.urlsafe_b64decode(padded.encode())
+        # excess "=" padding is ignored by the decoder
+        payload = base64.urlsafe_b64decode(token.encode("ascii") + b"==")
         info    = json.loads(payload).get("metadata", {})
+        if not isinstance(info, dict):
+            raise ValueError(f"metadata is {type(info).__name__}, not an object")
     except Exception as e:
         app.logger.error("Invalid metadata: %s", e)
-        return send_file(io.BytesIO(PIXEL_BYTES), mimetype="image/gif")
-
-    # Extract fields
-    email       = info.get("email")
-    sender      = info.get("sender")
-    sheet_tab   = info.get("sheet")
-    sheet_name  = info.get("sheet_name")
-    subject     = info.get("subject")
-    timezone    = info.get("timezone")
-    start_date  = info.get("date")
-    template    = info.get("template")
-    sent_time_s = info.get("sent_time")
+        return PIXEL_RESPONSE
+
+    # Extract fields; anything but a string is treated as missing
+    def text(field):
+        value = info.get(field)
+        return value if isinstance(value, str) else None
+
+    email       = (text("email") or "").strip().lower()  # stored normalised
+    sender      = text("sender")
+    sheet_tab   = text("sheet")
+    sheet_name  = text("sheet_name")
+    subject     = text("subject")
+    timezone    = text("timezone")
+    start_date  = text("date")
+    template    = text("template")
+    sent_time_s = text("sent_time")
 
     # Skip early hits < 7s
     if sent_time_s:
@@ -155,45 +885,86 @@ def track(path):
             sent_dt = datetime.fromisoformat(sent_time_s)
             if (now - sent_dt).total_seconds() < 7:
                 app.logger.info("Skipping early hit for %s", email)
-                return send_file(io.BytesIO(PIXEL_BYTES), mimetype="image/gif")
+                return PIXEL_RESPONSE
         except Exception:
             pass
 
-    # Open workbook & tab
-    try:
-        wb   = gc.open(MAILTRACKING_WORKBOOK)
-        tabs = [ws.title for ws in wb.worksheets()]
-        if not sheet_tab:
-            sheet_tab = tabs[0] if tabs else "USA"
-        if sheet_tab not in tabs:
-            wb.add_worksheet(title=sheet_tab, rows="1000", cols="20")
-        sheet = wb.worksheet(sheet_tab)
-    except Exception as e:
-        app.logger.error("Cannot open workbook/tab: %s", e)
-        return send_file(io.BytesIO(PIXEL_BYTES), mimetype="image/gif")
-
-    # Record the open
+    # Queue the open; the flusher writes it to Sheets
     if email and sender:
-        update_sheet(
-            sheet,
-            email=email,
-            sender=sender,
-            timestamp=timestamp,
-            sheet_name=sheet_name,
-            subject=subject,
-            timezone=timezone,
-            start_date=start_date,
-            template=template
-        )
-        app.logger.info("Tracked open: %s → %s at %s", email, sheet_tab, timestamp)
+        minute = now.replace(second=0, microsecond=0).timestamp()
+        if is_duplicate_hit((email, sender, minute)):
+            return PIXEL_RESPONSE
+        try:
+            buffer_open(
+                email, sender, timestamp, sheet_tab, sheet_name,
+                subject, timezone, start_date, template,
+            )
+        except sqlite3.Error as e:
+            # the pixel must load regardless; this open is lost
+            app.logger.error("Cannot buffer open for %s: %s", email, e)
 
-    return send_file(io.BytesIO(PIXEL_BYTES), mimetype="image/gif")
+    return PIXEL_RESPONSE
 
 
-@app.route('/health')
 def health():
     return "Tracker is live."
 
+
+# === Logging ===
+# Request threads only enqueue log records; formatting and the write to
+# stderr happen on the listener thread
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # the stock prepare() formats on the calling thread so the record
+        # can be pickled; this queue never leaves the process
+        return record
+
+
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(default_handler.formatter)
+queue_handler = _DeferredQueueHandler(queue.Queue(-1))
+log_listener  = None
+_log_pid      = None
+
+
+def _start_log_listener():
+    # a fresh queue per process: one inherited across fork still lists the
+    # parent's listener as its waiter and would never wake ours
+    global log_listener, _log_pid
+    if _log_pid == os.getpid():
+        return  # already running (start_worker retried after a later step failed)
+    queue_handler.queue = queue.Queue(-1)
+    log_listener = QueueListener(
+        queue_handler.queue, _log_handler, respect_handler_level=True
+    )
+    log_listener.start()
+    atexit.register(log_listener.stop)  # drain queued records on exit
+    _log_pid = os.getpid()
+
+
+def create_app() -> Flask:
+    """
+    Build the Flask app: logging and URL rules.
+
+    Not a parameterised factory. The schema is the module-level SCHEMA
+    (picked by the SCHEMA env var) and the flusher logs through the
+    module-level `app`, so build one app per process.
+    """
+    flask_app = Flask(__name__)
+    if default_handler in flask_app.logger.handlers:
+        # only when Flask would log to stderr itself; otherwise leave the
+        # host's logging configuration alone
+        flask_app.logger.removeHandler(default_handler)
+        flask_app.logger.addHandler(queue_handler)
+    flask_app.add_url_rule('/', 'track', track, defaults={'path': ''})
+    flask_app.add_url_rule('/<path:path>', 'track', track)
+    flask_app.add_url_rule('/health', 'health', health)
+    return flask_app
+
+
+app = create_app()
+
 if __name__ == "__main__":
+    start_worker()  # flush opens left over from the last run straight away
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port)
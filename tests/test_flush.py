@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault("GOOGLE_CREDS_JSON", "{}")
+os.environ["OPENS_DB"]       = os.path.join(_tmp, "opens.db")
+os.environ["ROW_INDEX_PATH"] = os.path.join(_tmp, "row_index.pkl")
+
+with mock.patch("google.oauth2.service_account.Credentials.from_service_account_info"):
+    import app
+
+import gspread
+
+
+class FlushTest(unittest.TestCase):
+    def setUp(self):
+        app._open_db()
+        app.db.execute("DELETE FROM opens")
+        app.db.execute("DELETE FROM dead_opens")
+
+        self.client = mock.Mock()
+        self.client.request.return_value.json.return_value = {
+            "properties": {"title": "MailTracking"}
+        }
+        sheet = mock.Mock(title="USA")
+        sheet.spreadsheet = gspread.Spreadsheet(self.client, {"id": "SID"})
+        self.client.request.reset_mock()
+
+        self.range = {"range": "'USA'!D2", "values": [["2"]]}
+
+        def update_sheet(sheet, opens):
+            return [self.range], opens, [], []
+
+        for patch in (
+            mock.patch.object(app, "get_ws", return_value=sheet),
+            mock.patch.object(app, "update_sheet", side_effect=update_sheet),
+            mock.patch.object(app, "save_row_index"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_existing_leads_are_sent_as_batch_update_body(self):
+        app.buffer_open(
+            "a@x.com", "s", "2024-01-01 10:00:00", "USA", None, None, None, None, None
+        )
+
+        app.flush_opens()
+
+        self.client.request.assert_called_once()
+        (method, url), kwargs = self.client.request.call_args
+        self.assertEqual(method, "post")
+        self.assertTrue(url.endswith("/SID/values:batchUpdate"))
+        self.assertIsNone(kwargs.get("params"))
+        self.assertEqual(kwargs["json"], {"valueInputOption": "RAW", "data": [self.range]})
+
+        # written, so settled rather than retried or dead-lettered
+        self.assertEqual(app.db.execute("SELECT COUNT(*) FROM opens").fetchone(), (0,))
+        self.assertEqual(app.db.execute("SELECT COUNT(*) FROM dead_opens").fetchone(), (0,))
+
+
+if __name__ == "__main__":
+    unittest.main()